@@ -3,6 +3,7 @@
 
 """RS21 API """
 
+import os
 import logging
 import argparse
 import yaml
@@ -11,9 +12,14 @@ from aiohttp import web
 from aiohttp_swagger3 import SwaggerDocs, SwaggerUiSettings
 
 from rs21_test.lib.db import DatabaseConfig
-from rs21_test.app.handlers.facebook import FacebookHandler, FacebookTypePlacesHandler
-from rs21_test.app.handlers.twitter import TwitterHandler, TwitterByIdHandler
-from rs21_test.app.handlers.bernallio import BernallioHandler, BernallioGeometriesHandler
+from rs21_test.lib.cache import LRUCache
+from rs21_test.lib.geo import GeoQueryCache
+from rs21_test.app.singleflight import SingleFlight
+from rs21_test.app.profiler import RequestProfiler
+from rs21_test.app.derived import DerivedFieldsQueue
+from rs21_test.app.handlers.facebook import FacebookPlacesIndex
+from rs21_test.app.openapi import SwaggerSpec, TITLE, VERSION
+from rs21_test.app.routes import routes
 
 
 def main():
@@ -23,10 +29,26 @@ def main():
     parser.add_argument('-c', '--config', dest='config', help='config file', required=True)
     args = parser.parse_args()
 
-    app = web.Application()
-
     with open(args.config, 'r') as fd:
-        app.cfg = yaml.safe_load(fd)
+        cfg = yaml.safe_load(fd)
+
+    singleflight = SingleFlight()
+    middlewares = [singleflight.middleware]
+
+    # opt-in request profiling, debug deployments only
+    profile_cfg = cfg['APP'].get('PROFILE')
+    if cfg['APP'].get('DEBUG') and profile_cfg:
+        profiler = RequestProfiler(
+            profile_cfg['DIR'],
+            sample_rate=float(profile_cfg.get('SAMPLE_RATE', 0)),
+            secret=profile_cfg.get('SECRET'),
+            max_dumps=int(profile_cfg.get('MAX_DUMPS', 100))
+        )
+        middlewares.insert(0, profiler.middleware)
+
+    app = web.Application(middlewares=middlewares)
+    app.cfg = cfg
+    app.singleflight = singleflight
 
     app._db = DatabaseConfig.asyncmongo(
         app.cfg['MONGO_DB']['HOST'],
@@ -34,23 +56,55 @@ def main():
         app.cfg['MONGO_DB']['DB_NAME']
     )
 
-    handlers = [
-        web.get('/api/v1/facebook', FacebookHandler),
-        web.get('/api/v1/facebook_type_places', FacebookTypePlacesHandler),
-        web.get('/api/v1/twitter', TwitterHandler),
-        web.view('/api/v1/twitter/{id}', TwitterByIdHandler),
-        web.get('/api/v1/bernallio', BernallioHandler),
-        web.get('/api/v1/geometries', BernallioGeometriesHandler),
-    ]
-
-    swagger = SwaggerDocs(
-        app,
-        swagger_ui_settings=SwaggerUiSettings(path='/api/v1/docs'),
-        title='RS21 API',
-        version='0.1'
+    geo_cache_cfg = app.cfg['APP'].get('GEO_CACHE', {})
+    app.geo_cache = GeoQueryCache(
+        cell_size=float(geo_cache_cfg.get('CELL_SIZE', 0.001)),
+        dist_step=int(geo_cache_cfg.get('DIST_STEP', 100)),
+        max_entries=int(geo_cache_cfg.get('MAX_ENTRIES', 1024)),
+        max_candidates=int(geo_cache_cfg.get('MAX_CANDIDATES', 5000)),
+        ttl=int(geo_cache_cfg.get('TTL', 600)),
+        refresh_interval=int(geo_cache_cfg.get('REFRESH_INTERVAL', 10))
+    )
+    app.on_startup.append(app.geo_cache.start)
+    app.on_cleanup.append(app.geo_cache.stop)
+
+    facebook_index_cfg = app.cfg['APP'].get('FACEBOOK_INDEX', {})
+    app.facebook_index = FacebookPlacesIndex(
+        cell_size=int(facebook_index_cfg.get('CELL_SIZE', 250)),
+        refresh_interval=int(facebook_index_cfg.get('REFRESH_INTERVAL', 60))
+    )
+    app.on_startup.append(app.facebook_index.start)
+    app.on_cleanup.append(app.facebook_index.stop)
+
+    derived_queue_cfg = app.cfg['APP'].get('DERIVED_QUEUE', {})
+    app.derived_queue = DerivedFieldsQueue(
+        workers=int(derived_queue_cfg.get('WORKERS', 2)),
+        batch_size=int(derived_queue_cfg.get('BATCH_SIZE', 100)),
+        poll_interval=int(derived_queue_cfg.get('POLL_INTERVAL', 5)),
+        lease=int(derived_queue_cfg.get('LEASE', 60))
     )
+    app.on_startup.append(app.derived_queue.start)
+    app.on_cleanup.append(app.derived_queue.stop)
+
+    app.choropleth_cache = LRUCache(max_bytes=int(app.cfg['APP'].get('CHOROPLETH_CACHE_BYTES', 256 * 1024 * 1024)))
+
+    # the prebuilt spec skips parsing and validating every handler docstring on start
+    spec_file = app.cfg['APP'].get('OPENAPI_SPEC')
+    swagger = None
+    if spec_file and os.path.exists(spec_file):
+        try:
+            swagger = SwaggerSpec(app, spec_file, routes, swagger_ui_settings=SwaggerUiSettings(path='/api/v1/docs'))
+        except (OSError, ValueError) as e:
+            logging.warning("Unable to load the OpenAPI spec, parsing the handlers docstrings instead, {}".format(e))
+    if swagger is None:
+        swagger = SwaggerDocs(
+            app,
+            swagger_ui_settings=SwaggerUiSettings(path='/api/v1/docs'),
+            title=TITLE,
+            version=VERSION
+        )
 
-    swagger.add_routes(handlers)
+    swagger.add_routes(routes)
     web.run_app(app, host=app.cfg['APP']['HOST'], port=int(app.cfg['APP']['PORT']))
 
 
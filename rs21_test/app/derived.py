@@ -0,0 +1,224 @@
+# -*- coding: utf-8 -*-
+
+"""Background recomputation of tweet derived fields"""
+
+import uuid
+import asyncio
+import datetime
+import logging
+
+from pymongo import ASCENDING, UpdateOne
+from pymongo.errors import BulkWriteError
+from vaderSentiment.vaderSentiment import SentimentIntensityAnalyzer
+
+from rs21_test.lib.sentiment import get_sentiment
+
+# Set by PATCH to {<field>: datetime, ..., 'at': datetime of the latest mark}, removed once the fields are recomputed.
+# Workers add 'claim' and 'claimed_until' while they hold the tweet.
+PENDING_FIELD = 'derived_pending'
+# Marks whose recomputation could not be written, {<field>: datetime}, kept for inspection
+FAILED_FIELD = 'derived_failed'
+DERIVED_FIELDS = ('location', 'sentiment')
+# Matches every marked tweet through the index on PENDING_FIELD.at, unlike $exists
+PENDING_FILTER = {PENDING_FIELD + '.at': {'$gte': datetime.datetime.min}}
+
+
+class DerivedFieldsQueue:
+    """
+    Worker pool recomputing ``location`` and ``sentiment`` of patched tweets.
+
+    The queue lives in Mongo: PATCH marks each field to recompute under ``PENDING_FIELD`` in the same ``$set``,
+    workers claim marked tweets by batches for ``lease`` seconds, so the pools of all the API processes share the
+    queue, and unset a field mark only if it was not renewed meanwhile. A tweet is therefore processed at least once,
+    even across restarts (an expired claim is picked again), and a PATCH racing with a worker is never lost. Marks
+    whose write fails are moved to ``FAILED_FIELD`` instead of being retried forever.
+    """
+
+    def __init__(self, workers=2, batch_size=100, poll_interval=5, lease=60):
+        self.workers = workers
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self.lease = lease
+        self.processed = 0
+        self.failed_batches = 0
+        self.dead_lettered = 0
+        self._analyser = SentimentIntensityAnalyzer()
+        self._tasks = []
+        self._wakeup = None
+
+    @staticmethod
+    def mark(fields: list) -> dict:
+        """
+        ``$set`` values enqueueing the tweet for recomputation of ``fields``, marks of other fields are kept
+        """
+        at = datetime.datetime.utcnow()
+        values = {PENDING_FIELD + '.' + field: at for field in fields}
+        values[PENDING_FIELD + '.at'] = at
+        return values
+
+    @staticmethod
+    def unmark(fields: list) -> dict:
+        """
+        ``$unset`` values dropping pending recomputations of ``fields``, e.g. when the caller sets them explicitly
+        """
+        return {PENDING_FIELD + '.' + field: '' for field in fields}
+
+    def notify(self):
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    async def stats(self, db) -> dict:
+        depth = await db.twitter.count_documents(PENDING_FILTER)
+        oldest = await db.twitter.find_one(
+            PENDING_FILTER,
+            {PENDING_FIELD: 1},
+            sort=[(PENDING_FIELD + '.at', ASCENDING)]
+        )
+        lag = (datetime.datetime.utcnow() - oldest[PENDING_FIELD]['at']).total_seconds() if oldest else 0
+        return {
+            'depth': depth,
+            'lag': lag,
+            'processed': self.processed,
+            'failed_batches': self.failed_batches,
+            'dead_lettered': self.dead_lettered,
+            'workers': self.workers,
+        }
+
+    @staticmethod
+    def _pending(doc: dict) -> dict:
+        return {field: at for field, at in doc[PENDING_FIELD].items() if field in DERIVED_FIELDS}
+
+    def _compute(self, doc: dict) -> dict:
+        fields = self._pending(doc)
+        values = {}
+
+        if 'location' in fields:
+            lon, lat = doc.get('location', {}).get('coordinates', [None, None])
+            lon = doc.get('lon', lon)
+            lat = doc.get('lat', lat)
+            try:
+                values['location'] = {"type": "Point", "coordinates": [float(lon), float(lat)]}
+            except (TypeError, ValueError):
+                logging.warning("Tweet {} has no valid lat/lon, location is left as is".format(doc['_id']))
+
+        if 'sentiment' in fields and doc.get('tweet') is not None:
+            values['sentiment'] = get_sentiment(self._analyser.polarity_scores(doc['tweet'])['compound'])
+
+        return values
+
+    def _compute_batch(self, docs: list) -> list:
+        return [self._compute(doc) for doc in docs]
+
+    async def _write(self, app, docs: list, batch: list):
+        # one compare-and-set per field, a mark renewed or dropped by a PATCH meanwhile is left alone
+        requests, marks = [], []
+        for doc, values in zip(docs, batch):
+            for field, at in self._pending(doc).items():
+                update = {'$unset': {PENDING_FIELD + '.' + field: ''}}
+                if field in values:
+                    update['$set'] = {field: values[field]}
+                requests.append(UpdateOne({'_id': doc['_id'], PENDING_FIELD + '.' + field: at}, update))
+                marks.append((doc['_id'], field, at))
+        if not requests:
+            return
+
+        try:
+            await app._db.twitter.bulk_write(requests, ordered=False)
+        except BulkWriteError as e:
+            # the failing writes would fail again on every poll, keep their marks aside instead
+            dead = []
+            for error in e.details.get('writeErrors', []):
+                _id, field, at = marks[error['index']]
+                logging.error("Unable to write derived {} of tweet {}, {}".format(field, _id, error['errmsg']))
+                dead.append(UpdateOne({'_id': _id, PENDING_FIELD + '.' + field: at}, {
+                    '$unset': {PENDING_FIELD + '.' + field: ''},
+                    '$set': {FAILED_FIELD + '.' + field: at},
+                }))
+            if dead:
+                await app._db.twitter.bulk_write(dead, ordered=False)
+                self.dead_lettered += len(dead)
+
+    async def _claim(self, db):
+        """
+        Claim the oldest unclaimed marked tweets, claims of other workers are skipped until their lease expires
+        :return: claim id and claimed tweets
+        """
+        now = datetime.datetime.utcnow()
+        unclaimed = {'$or': [
+            {PENDING_FIELD + '.claimed_until': {'$exists': False}},
+            {PENDING_FIELD + '.claimed_until': {'$lt': now}},
+        ]}
+        candidates = await db.twitter.find(
+            dict(PENDING_FILTER, **unclaimed), {'_id': 1}
+        ).sort(PENDING_FIELD + '.at', ASCENDING).limit(self.batch_size).to_list(length=None)
+        if not candidates:
+            return None, []
+
+        # the same filter again, a worker racing for the same candidates gets only those it won
+        claim = uuid.uuid4().hex
+        await db.twitter.update_many(
+            dict(unclaimed, _id={'$in': [doc['_id'] for doc in candidates]}),
+            {'$set': {
+                PENDING_FIELD + '.claim': claim,
+                PENDING_FIELD + '.claimed_until': now + datetime.timedelta(seconds=self.lease),
+            }}
+        )
+        docs = await db.twitter.find(
+            {PENDING_FIELD + '.claim': claim}
+        ).sort(PENDING_FIELD + '.at', ASCENDING).to_list(length=None)
+        return claim, docs
+
+    async def _process_batch(self, app) -> int:
+        claim, docs = await self._claim(app._db)
+        if not docs:
+            return 0
+
+        try:
+            # VADER is CPU bound, keep it off the event loop
+            batch = await asyncio.get_event_loop().run_in_executor(None, self._compute_batch, docs)
+            await self._write(app, docs, batch)
+            # sentiment filters are cached too, not only the locations
+            if any(batch):
+                await app.geo_cache.written(app._db, 'twitter')
+            # drop the emptied marks, unless a PATCH marked the tweet again meanwhile
+            requests = []
+            for doc in docs:
+                query = {'_id': doc['_id'], PENDING_FIELD + '.at': doc[PENDING_FIELD]['at']}
+                query.update({PENDING_FIELD + '.' + field: {'$exists': False} for field in DERIVED_FIELDS})
+                requests.append(UpdateOne(query, {'$unset': {PENDING_FIELD: ''}}))
+            await app._db.twitter.bulk_write(requests, ordered=False)
+        finally:
+            # marks renewed meanwhile are left for the next batch right away
+            await app._db.twitter.update_many(
+                {PENDING_FIELD + '.claim': claim},
+                {'$unset': {PENDING_FIELD + '.claim': '', PENDING_FIELD + '.claimed_until': ''}}
+            )
+
+        self.processed += len(docs)
+        return len(docs)
+
+    async def _worker(self, app):
+        while True:
+            try:
+                count = await self._process_batch(app)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logging.error("Unable to recompute tweets derived fields, {}".format(e))
+                self.failed_batches += 1
+                count = 0
+
+            if count < self.batch_size:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), self.poll_interval)
+                except asyncio.TimeoutError:
+                    pass
+                self._wakeup.clear()
+
+    async def start(self, app):
+        self._wakeup = asyncio.Event()
+        self._tasks = [asyncio.ensure_future(self._worker(app)) for _ in range(self.workers)]
+
+    async def stop(self, app):
+        for task in self._tasks:
+            task.cancel()
@@ -7,11 +7,44 @@ import re
 from aiohttp import web
 
 from rs21_test.lib.misc import json_dumps
+from rs21_test.lib.profiling import phase
 
 MIN_AGE = 0
 MAX_AGE = 130
 
 
+async def find_age_categories(db, minage: int, maxage: int, gender: str) -> list:
+    """
+    Census age/gender categories within the age range
+    """
+    re_gender = re.compile(r'^({})$'.format(gender if gender != 'any' else 'female|male'), re.IGNORECASE)
+    return await db.census_filters.find(
+        {
+            'type': 'age',
+            'min': {'$gte': minage},
+            'max': {'$lte': maxage},
+            'gender': re_gender
+        },
+        {
+            '_id': 0,
+        }
+    ).to_list(length=None)
+
+
+def category_field(category: dict) -> str:
+    return category["meta_index"] + "_with_ann_" + category["category"]
+
+
+def to_number(value) -> float:
+    """
+    Census value as number, annotations like '(X)' or '-' count as 0
+    """
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return 0
+
+
 class BernallioHandler(web.View):
     """Bernallio handler"""
 
@@ -47,38 +80,30 @@ class BernallioHandler(web.View):
             description: 'Return Bernallio Census data'
         """
 
-        minage = int(self.request.rel_url.query.get('agemin', MIN_AGE))
-        maxage = int(self.request.rel_url.query.get('agemax', MAX_AGE))
-        gender = self.request.rel_url.query.get('gender', "any").lower()
+        # validated and typed by the swagger layer
+        params = self.request['data']
+        minage = int(params.get('agemin', MIN_AGE))
+        maxage = int(params.get('agemax', MAX_AGE))
+        gender = params.get('gender', "any").lower()
 
         result = {}
 
         if all([minage, maxage, gender]):
-            re_gender = re.compile(r'^({})$'.format(gender if gender != 'any' else 'female|male'), re.IGNORECASE)
-            categories = await self.request.app._db.census_filters.find(
-                {
-                    'type': 'age',
-                    'min': {'$gte': minage},
-                    'max': {'$lte': maxage},
-                    'gender': re_gender
-                },
-                {
-                    '_id': 0,
-                }
-            ).to_list(length=None)
-            result['categories'] = categories
+            with phase('mongo'):
+                result['categories'] = await find_age_categories(self.request.app._db, minage, maxage, gender)
 
             return_set = {
                 '_id': 0,
                 "GEOID": 1,
             }
             for category in result['categories']:
-                filter_field = category["meta_index"] + "_with_ann_" + category["category"]
-                return_set[filter_field] = 1
+                return_set[category_field(category)] = 1
 
-            query = await self.request.app._db.cities.find({}, return_set).to_list(length=None)
+            with phase('mongo'):
+                query = await self.request.app._db.cities.find({}, return_set).to_list(length=None)
             result['filter'] = query
-        return web.json_response(result, dumps=json_dumps)
+        with phase('serialize'):
+            return web.json_response(result, dumps=json_dumps)
 
 
 class BernallioGeometriesHandler(web.View):
@@ -95,5 +120,90 @@ class BernallioGeometriesHandler(web.View):
             description: 'Return Bernallio geometries'
         """
 
-        result = await self.request.app._db.geometries.find({}, {'_id': 0}).to_list(length=None)
-        return web.json_response(result, dumps=json_dumps)
\ No newline at end of file
+        with phase('mongo'):
+            result = await self.request.app._db.geometries.find({}, {'_id': 0}).to_list(length=None)
+        with phase('serialize'):
+            return web.json_response(result, dumps=json_dumps)
+
+
+class BernallioChoroplethHandler(web.View):
+    """Bernallio choropleth handler"""
+
+    async def get(self) -> web.Response:
+        """
+        ---
+        summary: 'Get Bernallio tracts with census values as GeoJSON FeatureCollection'
+        tags:
+          - Census
+        parameters:
+          - name: agemin
+            description: "Age from"
+            in: query
+            required: false
+            example: 18
+            schema:
+              type: number
+          - name: agemax
+            description: "Age before"
+            in: query
+            required: false
+            example: 56
+            schema:
+              type: number
+          - name: gender
+            description: "Gender"
+            in: query
+            schema:
+              type: string
+              enum: ["any", "male", "female"]
+        responses:
+          '200':
+            description: >
+              Return FeatureCollection of tracts, properties hold the selected categories values and `value`,
+              the sum of their estimates
+        """
+
+        # validated and typed by the swagger layer
+        params = self.request['data']
+        minage = int(params.get('agemin', MIN_AGE))
+        maxage = int(params.get('agemax', MAX_AGE))
+        gender = params.get('gender', "any").lower()
+
+        db = self.request.app._db
+        with phase('mongo'):
+            dataset = await db.datasets.find_one({'_id': 'bernallio'})
+            categories = await find_age_categories(db, minage, maxage, gender)
+        fields = sorted(category_field(category) for category in categories)
+        estimates = [category_field(category) for category in categories if category['subtype'] == 'Estimate']
+
+        # age ranges selecting the same categories share one body
+        cache_key = (dataset['version'] if dataset else None, tuple(fields))
+
+        body = self.request.app.choropleth_cache.get(cache_key)
+        if body is None:
+            return_set = {
+                '_id': 0,
+                'GEOID': 1,
+                'geometry': 1,
+            }
+            for field in fields:
+                return_set['values.' + field] = 1
+
+            features = []
+            async for doc in db.choropleth.find({}, return_set):
+                values = doc.get('values', {})
+                properties = {'GEOID': doc['GEOID']}
+                properties.update(values)
+                properties['value'] = sum(to_number(values.get(field)) for field in estimates)
+                features.append({
+                    'type': 'Feature',
+                    'geometry': doc['geometry'],
+                    'properties': properties,
+                })
+
+            with phase('serialize'):
+                body = json_dumps({'type': 'FeatureCollection', 'features': features}).encode('utf-8')
+            self.request.app.choropleth_cache.set(cache_key, body)
+
+        return web.Response(body=body, content_type='application/json')
+
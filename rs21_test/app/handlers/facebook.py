@@ -1,10 +1,80 @@
 # -*- coding: utf-8 -*-
 
 import re
+import asyncio
+import logging
 
 from aiohttp import web
 
-from rs21_test.lib.misc import json_dumps
+from rs21_test.lib.misc import json_dumps, normalize_key
+from rs21_test.lib.profiling import phase
+from rs21_test.lib.spatial import GridIndex
+
+# normalized lookup keys are internal
+PROJECTION = {'_id': 0, 'place_key': 0, 'type_key': 0}
+
+
+class FacebookPlacesIndex:
+    """
+    In-memory k-nearest/radius index over Facebook places.
+
+    Built at startup and rebuilt whenever the loader publishes a new ``facebook`` dataset version, requests fall back
+    to Mongo while it is cold.
+    """
+
+    def __init__(self, cell_size=250, refresh_interval=60):
+        self.cell_size = cell_size
+        self.refresh_interval = refresh_interval
+        self.version = None
+        self._index = None
+        self._task = None
+
+    @property
+    def ready(self) -> bool:
+        return self._index is not None
+
+    def near(self, lon: float, lat: float, dist=None, k=None, predicate=None) -> list:
+        return [item[0] for item in self._index.near(lon, lat, dist, k, predicate)]
+
+    async def refresh(self, db) -> bool:
+        """
+        Rebuild the index if the dataset version changed
+        :return: True if the index was rebuilt
+        """
+        dataset = await db.datasets.find_one({'_id': 'facebook'})
+        version = dataset['version'] if dataset else None
+        if self._index is not None and version == self.version:
+            return False
+
+        points = []
+        async for doc in db.facebook.find({}, {'_id': 0}):
+            lon, lat = doc['location']['coordinates']
+            place_key = doc.pop('place_key', '')
+            type_key = doc.pop('type_key', '')
+            points.append((lon, lat, (doc, place_key, type_key)))
+
+        self._index = GridIndex(points, self.cell_size)
+        self.version = version
+        logging.info("Facebook places index built, {} places, version {}".format(len(points), version))
+        return True
+
+    async def _run(self, app):
+        while True:
+            try:
+                if await self.refresh(app._db):
+                    app.geo_cache.invalidate('facebook')
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logging.error("Unable to refresh Facebook places index, {}".format(e))
+            await asyncio.sleep(self.refresh_interval)
+
+    async def start(self, app):
+        self._task = asyncio.ensure_future(self._run(app))
+
+    async def stop(self, app):
+        if self._task is not None:
+            self._task.cancel()
 
 
 class FacebookHandler(web.View):
@@ -18,13 +88,13 @@ class FacebookHandler(web.View):
           - Facebook
         parameters:
           - name: query
-            description: "Name of place (or multiple with comma separated)"
+            description: "Name of place prefix, case-insensitive (or multiple with comma separated)"
             in: query
             required: false
             schema:
               type: string
           - name: type
-            description: "Place type (or multiple with comma separated)"
+            description: "Place type prefix, case-insensitive (or multiple with comma separated)"
             in: query
             required: false
             schema:
@@ -36,6 +106,8 @@ class FacebookHandler(web.View):
             example: 35.05917399
             schema:
               type: number
+              minimum: -90
+              maximum: 90
           - name: lon
             description: "Facebook geo location, longitude"
             in: query
@@ -43,62 +115,112 @@ class FacebookHandler(web.View):
             example: -106.5821513
             schema:
               type: number
+              minimum: -180
+              maximum: 180
           - name: dist
-            description: "Distance in meters from geo position"
+            description: "Distance in meters from geo position (100 if limit is not set)"
             in: query
             required: false
             example: 100
             schema:
               type: number
+          - name: limit
+            description: "Max number of places, the nearest ones for a geo position"
+            in: query
+            required: false
+            example: 10
+            schema:
+              type: integer
+              minimum: 1
         responses:
           '200':
             description: 'Return list of Facebook places'
         """
 
-        place = self.request.rel_url.query.get('query', None)
-        place_type = self.request.rel_url.query.get('type', None)
-        lat = self.request.rel_url.query.get('lat', None)
-        lon = self.request.rel_url.query.get('lon', None)
-        dist = int(self.request.rel_url.query.get('dist', 100))
+        # validated and typed by the swagger layer
+        params = self.request['data']
+        place = params.get('query')
+        place_type = params.get('type')
+        lat = params.get('lat')
+        lon = params.get('lon')
+        dist = params.get('dist')
+        limit = params.get('limit')
+        geo = lat is not None and lon is not None
+
+        # k-nearest lookups are not bounded by the default distance
+        if dist is not None or limit is None:
+            dist = int(dist if dist is not None else 100)
+
+        place_prefixes = tuple(normalize_key(x) for x in place.split(',')) if place else ()
+        type_prefixes = tuple(normalize_key(x) for x in place_type.split(',')) if place_type else ()
+
+        index = self.request.app.facebook_index
+        if geo and index.ready:
+            def predicate(item):
+                _, place_key, type_key = item
+                return (not place_prefixes or place_key.startswith(place_prefixes)) and \
+                       (not type_prefixes or type_key.startswith(type_prefixes))
+
+            with phase('index'):
+                result = index.near(lon, lat, dist, limit, predicate)
+            with phase('serialize'):
+                return web.json_response(result, dumps=json_dumps)
 
         filter_query = []
 
-        if place:
+        # anchored prefix on the lower-cased keys, served from their indexes
+        if place_prefixes:
             place_queries = []
-            for place_query in place.split(','):
-                q_str = re.compile(r'^.*?{}.*?$'.format(place_query.rstrip(' ').lstrip(' ').replace(r' ', r'\s+')), re.IGNORECASE)
-                place_queries.append({'place': q_str})
+            for place_query in place_prefixes:
+                q_str = re.compile(r'^{}'.format(re.escape(place_query)))
+                place_queries.append({'place_key': q_str})
             filter_query.append({
                 '$or': place_queries
             })
 
-        if place_type:
+        if type_prefixes:
             place_queries = []
-            for place_type_query in place_type.split(','):
-                q_str = re.compile(r'^.*?{}.*?$'.format(place_type_query.rstrip(' ').lstrip(' ').replace(r' ', r'\s+')), re.IGNORECASE)
-                place_queries.append({'type': q_str})
+            for place_type_query in type_prefixes:
+                q_str = re.compile(r'^{}'.format(re.escape(place_type_query)))
+                place_queries.append({'type_key': q_str})
             filter_query.append({
                 '$or': place_queries
             })
 
-        if all([lon, lat]):
-            filter_query.append({
-                'location': {
-                    '$near': {
-                        '$geometry': {
-                           'type': "Point",
-                            'coordinates': [float(lon), float(lat)]},
-                        '$maxDistance': dist
-                    }
-                }
-            })  # 100 meters
-
         query_filter = {}
         if filter_query:
             query_filter = {"$and": filter_query}
 
-        result = await self.request.app._db.facebook.find(query_filter, {'_id': 0}).to_list(length=None)
-        return web.json_response(result, dumps=json_dumps)
+        # geo filter while the index is cold
+        if geo and dist is None:
+            # k-nearest, $near returns the closest first
+            query_filter['location'] = {
+                '$near': {
+                    '$geometry': {
+                        'type': "Point",
+                        'coordinates': [lon, lat]}
+                }
+            }
+            with phase('mongo'):
+                result = await self.request.app._db.facebook.find(query_filter, PROJECTION).limit(limit).to_list(length=None)
+        elif geo:
+            # served by cell from the geo cache
+            result = await self.request.app.geo_cache.near(
+                self.request.app._db.facebook,
+                query_filter,
+                lon,
+                lat,
+                dist,
+                projection=PROJECTION,
+                key=(place_prefixes, type_prefixes)
+            )
+            result = result[:limit]
+        else:
+            with phase('mongo'):
+                result = await self.request.app._db.facebook.find(query_filter, PROJECTION).limit(limit or 0).to_list(length=None)
+
+        with phase('serialize'):
+            return web.json_response(result, dumps=json_dumps)
 
 
 class FacebookTypePlacesHandler(web.View):
@@ -117,7 +239,9 @@ class FacebookTypePlacesHandler(web.View):
 
         all_types = list()
         pipline = [{"$sort": {"type": 1}}, {"$group": {"_id": "$type"}}]
-        async for doc in self.request.app._db.facebook.aggregate(pipline):
-            all_types.append(doc.get('_id'))
-        return web.json_response({"all_types": all_types}, dumps=json_dumps)
+        with phase('mongo'):
+            async for doc in self.request.app._db.facebook.aggregate(pipline):
+                all_types.append(doc.get('_id'))
+        with phase('serialize'):
+            return web.json_response({"all_types": all_types}, dumps=json_dumps)
 
@@ -0,0 +1,26 @@
+# -*- coding: utf-8 -*-
+
+from aiohttp import web
+
+from rs21_test.lib.misc import json_dumps
+
+
+class MetricsHandler(web.View):
+    """Metrics handler"""
+
+    async def get(self) -> web.Response:
+        """
+        ---
+        summary: 'Get API runtime metrics'
+        tags:
+          - Service
+        responses:
+          '200':
+            description: 'Return API runtime metrics'
+        """
+
+        result = {
+            'singleflight': self.request.app.singleflight.stats(),
+            'derived_queue': await self.request.app.derived_queue.stats(self.request.app._db),
+        }
+        return web.json_response(result, dumps=json_dumps)
@@ -8,7 +8,12 @@ from aiohttp import web
 from bson.objectid import ObjectId
 from bson.errors import InvalidId
 
-from rs21_test.lib.misc import json_dumps
+from rs21_test.lib.misc import json_dumps, normalize_key
+from rs21_test.lib.profiling import phase
+from rs21_test.app.derived import DerivedFieldsQueue, PENDING_FIELD, FAILED_FIELD
+
+# normalized lookup keys and queue marks are internal
+PROJECTION = {'username_key': 0, PENDING_FIELD: 0, FAILED_FIELD: 0}
 
 
 class TwitterByIdHandler(web.View):
@@ -61,11 +66,13 @@ class TwitterByIdHandler(web.View):
             description: 'Wrong parameter'
         """
 
-        result = await self.request.app._db.twitter.find_one({"_id": self._get_object_id()})
+        with phase('mongo'):
+            result = await self.request.app._db.twitter.find_one({"_id": self._get_object_id()}, PROJECTION)
         if not result:
             return self._raise_not_found()
 
-        return web.json_response(result, dumps=json_dumps)
+        with phase('serialize'):
+            return web.json_response(result, dumps=json_dumps)
 
     async def delete(self) -> web.Response:
         """
@@ -91,6 +98,7 @@ class TwitterByIdHandler(web.View):
         result = await self.request.app._db.twitter.delete_one({"_id": self._get_object_id()})
         if result.deleted_count == 0:
             return self._raise_not_found()
+        await self.request.app.geo_cache.written(self.request.app._db, 'twitter')
 
         resp = {
             "code": 0,
@@ -131,6 +139,8 @@ class TwitterByIdHandler(web.View):
             example: 35.08063
             schema:
               type: number
+              minimum: -90
+              maximum: 90
           - name: lon
             description: "Tweet geo location, longitude"
             in: query
@@ -138,6 +148,8 @@ class TwitterByIdHandler(web.View):
             example: -106.37636
             schema:
               type: number
+              minimum: -180
+              maximum: 180
           - name: sentiment
             description: >
               Tweet sentiment:
@@ -147,7 +159,8 @@ class TwitterByIdHandler(web.View):
             in: query
             required: false
             schema:
-              type: string
+              type: integer
+              enum: [1, 0, -1]
         responses:
           '200':
             description: 'Patched'
@@ -157,30 +170,49 @@ class TwitterByIdHandler(web.View):
             description: 'Wrong parameter'
         """
 
-        username = self.request.rel_url.query.get('username')
-        tweet = self.request.rel_url.query.get('tweet')
-        lat = self.request.rel_url.query.get('lat')
-        lon = self.request.rel_url.query.get('lon')
-        sentiment = self.request.rel_url.query.get('sentiment')
+        # validated and typed by the swagger layer
+        params = self.request['data']
+        username = params.get('username')
+        tweet = params.get('tweet')
+        lat = params.get('lat')
+        lon = params.get('lon')
+        sentiment = params.get('sentiment')
 
         new_values = dict()
+        # derived fields are recomputed by the background queue, the request only does the $set
+        derived = []
         if username:
             new_values['username'] = username
+            new_values['username_key'] = normalize_key(username)
         if tweet:
             new_values['tweet'] = tweet
-        if lat:
+            if sentiment is None:
+                derived.append('sentiment')
+        if lat is not None:
             new_values['lat'] = lat
-        if lon:
+        if lon is not None:
             new_values['lon'] = lon
-        if sentiment:
+        if lat is not None or lon is not None:
+            derived.append('location')
+        if sentiment is not None:
             new_values['sentiment'] = sentiment
 
-        result = await self.request.app._db.twitter.update_one({"_id": self._get_object_id()}, {"$set": new_values})
+        update = {"$set": new_values}
+        if derived:
+            new_values.update(DerivedFieldsQueue.mark(derived))
+        if sentiment is not None:
+            # an explicit value wins over a recomputation still pending from an earlier PATCH
+            update["$unset"] = DerivedFieldsQueue.unmark(['sentiment'])
+
+        result = await self.request.app._db.twitter.update_one({"_id": self._get_object_id()}, update)
         if result.matched_count == 0:
             # Frankly, we just check that object was found, in this case our PATCH reuqest is idempotent. If Mongo sees
             # that values are the same in BD than Mongo won't update these values. If you want to check that values were
             # updated use modified_count method
             return self._raise_not_found()
+        await self.request.app.geo_cache.written(self.request.app._db, 'twitter')
+        if derived:
+            self.request.app.derived_queue.notify()
 
         resp = {
             "code": 0,
@@ -219,6 +251,8 @@ class TwitterHandler(web.View):
             example: 35.08063
             schema:
               type: number
+              minimum: -90
+              maximum: 90
           - name: lon
             description: "Tweet geo location, longitude"
             in: query
@@ -226,6 +260,8 @@ class TwitterHandler(web.View):
             example: -106.37636
             schema:
               type: number
+              minimum: -180
+              maximum: 180
           - name: dist
             description: "Distance in meters from geo position"
             in: query
@@ -242,25 +278,27 @@ class TwitterHandler(web.View):
             in: query
             required: false
             schema:
-              type: string
+              type: integer
+              enum: [1, 0, -1]
         responses:
           '200':
             description: 'Return list of tweets'
         """
 
-        username = self.request.rel_url.query.get('username')
-        query = self.request.rel_url.query.get('query')
-        lat = self.request.rel_url.query.get('lat')
-        lon = self.request.rel_url.query.get('lon')
-        sentiment = self.request.rel_url.query.get('sentiment')
-        dist = int(self.request.rel_url.query.get('dist', 100))
+        # validated and typed by the swagger layer
+        params = self.request['data']
+        username = params.get('username')
+        query = params.get('query')
+        lat = params.get('lat')
+        lon = params.get('lon')
+        sentiment = params.get('sentiment')
+        dist = int(params.get('dist', 100))
 
         filter_query = {}
 
-        # filter by user name
+        # filter by user name, exact match on the indexed lower-cased key
         if username:
-            q_str = re.compile(r'^{}$'.format(username), re.I)
-            filter_query.update({'username': q_str})
+            filter_query.update({'username_key': normalize_key(username)})
 
         # filter by tweet content
         if query:
@@ -268,22 +306,23 @@ class TwitterHandler(web.View):
             filter_query.update({'tweet': q_str})
 
         # filter by sentiment
-        if sentiment:
-            filter_query.update({'sentiment': int(sentiment)})
+        if sentiment is not None:
+            filter_query.update({'sentiment': sentiment})
 
-        # geo filter
-        if all([lon, lat]):
-            # query = {'geo': {"$within": {"$polygon": polygon_geo}}}
-            filter_query.update({
-                'location': {
-                    '$near': {
-                        '$geometry': {
-                            'type': "Point",
-                            'coordinates': [float(lon), float(lat)]},
-                        '$maxDistance': dist
-                    }
-                }
-            })  # 100 meters
+        # geo filter, served by cell from the geo cache
+        if lat is not None and lon is not None:
+            result = await self.request.app.geo_cache.near(
+                self.request.app._db.twitter,
+                filter_query,
+                lon,
+                lat,
+                dist,
+                projection=PROJECTION,
+                key=(normalize_key(username) if username else None, query, sentiment)
+            )
+        else:
+            with phase('mongo'):
+                result = await self.request.app._db.twitter.find(filter_query, PROJECTION).to_list(length=None)
 
-        result = await self.request.app._db.twitter.find(filter_query).to_list(length=None)
-        return web.json_response(result, dumps=json_dumps)
+        with phase('serialize'):
+            return web.json_response(result, dumps=json_dumps)
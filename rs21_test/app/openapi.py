@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+
+"""Prebuilt OpenAPI spec"""
+
+import json
+import hashlib
+import inspect
+
+from aiohttp import hdrs, web
+from aiohttp_swagger3 import SwaggerDocs, SwaggerFile
+from aiohttp_swagger3.routes import _SWAGGER_SPECIFICATION
+from aiohttp_swagger3.swagger import Swagger
+
+TITLE = 'RS21 API'
+VERSION = '0.1'
+
+# Spec extension holding the hash of the docstrings the spec was built from
+HASH_KEY = 'x-docstrings-hash'
+
+
+def docstrings_hash(routes) -> str:
+    """
+    Hash of the routes handlers docstrings, tells whether a prebuilt spec still matches the code
+    """
+    digest = hashlib.sha1()
+    for route in routes:
+        handler = route.handler
+        if inspect.isclass(handler) and issubclass(handler, web.View):
+            docs = [getattr(handler, method.lower(), None) for method in sorted(hdrs.METH_ALL)]
+        else:
+            docs = [handler]
+        digest.update('{} {}\n'.format(route.method, route.path).encode('utf-8'))
+        for doc in docs:
+            digest.update(((doc.__doc__ if doc is not None else None) or '').encode('utf-8'))
+    return digest.hexdigest()
+
+
+class _HeadRouteMixin:
+    """
+    ``web.get()`` also registers HEAD, the view methods must be wrapped only once, by the GET route
+    """
+
+    __slots__ = ()
+
+    def add_route(self, method, path, handler, **kwargs):
+        if method == hdrs.METH_HEAD:
+            return self._app.router.add_route(method, path, handler, **kwargs)
+        return super().add_route(method, path, handler, **kwargs)
+
+
+class _SpecBuilder(_HeadRouteMixin, SwaggerDocs):
+    __slots__ = ()
+
+
+def build_spec(routes) -> dict:
+    """
+    Collect the OpenAPI document from the handlers docstrings, the spec is validated on the way
+    """
+    swagger = _SpecBuilder(web.Application(), validate=False, title=TITLE, version=VERSION)
+    swagger.add_routes(routes)
+    spec = json.loads(json.dumps(swagger.spec))
+    spec[HASH_KEY] = docstrings_hash(routes)
+    return spec
+
+
+class SwaggerSpec(_HeadRouteMixin, SwaggerFile):
+    """
+    Swagger loading the JSON spec written by ``tools/build_openapi.py``.
+
+    Handlers docstrings are not parsed and the spec is validated once instead of once per handler, the routes
+    validators are built straight from it. A spec built from other docstrings than the ones of ``routes`` is
+    rejected with ``ValueError``, as is an unreadable one, before anything is registered on the app.
+    """
+
+    __slots__ = ()
+
+    def __init__(self, app, spec_file, routes, *, validate=True, swagger_ui_settings=None):
+        with open(spec_file, 'r') as fd:
+            spec = json.load(fd)
+        if spec.get(HASH_KEY) != docstrings_hash(routes):
+            raise ValueError("{} is stale, rebuild it with tools/build_openapi.py".format(spec_file))
+
+        Swagger.__init__(
+            self,
+            app,
+            validate=validate,
+            spec=spec,
+            request_key='data',
+            swagger_ui_settings=swagger_ui_settings,
+            redoc_ui_settings=None,
+            rapidoc_ui_settings=None,
+        )
+        self._app[_SWAGGER_SPECIFICATION] = self.spec
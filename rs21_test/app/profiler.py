@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+
+"""Per-request profiling"""
+
+import os
+import re
+import hmac
+import json
+import time
+import uuid
+import random
+import cProfile
+import logging
+
+from aiohttp import web
+
+from rs21_test.lib.profiling import PhaseTimer
+
+HEADER = 'X-Profile'
+
+
+class RequestProfiler:
+    """
+    Profile single requests, asked for with the ``X-Profile`` header set to ``secret`` or picked with ``sample_rate``.
+
+    The request runs under cProfile and a phase timer. ``mongo``, ``index`` and ``serialize`` are timed by the
+    handlers, ``build`` is the rest of the handler time (query building, filtering) and ``write`` is sending the
+    response. The cProfile stats (``.prof``) and the phases (``.json``) are dumped to ``directory``, for failed requests
+    too, only the latest ``max_dumps`` are kept. Only one profile runs at a time, requests overlapping it are served
+    unprofiled. The profiler sees everything running in the loop meanwhile, it is meant for debug deployments only.
+    """
+
+    def __init__(self, directory, sample_rate=0.0, secret=None, max_dumps=100):
+        self.directory = directory
+        self.sample_rate = sample_rate
+        self.secret = secret
+        self.max_dumps = max_dumps
+        self._active = False
+        os.makedirs(self.directory, exist_ok=True)
+
+    def _requested(self, request: web.Request) -> bool:
+        # without a secret the header is ignored, anybody could send it
+        if self.secret and hmac.compare_digest(request.headers.get(HEADER, ''), self.secret):
+            return True
+        return bool(self.sample_rate) and random.random() < self.sample_rate
+
+    def _prune(self):
+        # names start with the timestamp, the oldest dumps sort first
+        names = sorted(name[:-len('.prof')] for name in os.listdir(self.directory) if name.endswith('.prof'))
+        for name in names[:max(len(names) - self.max_dumps, 0)]:
+            for ext in ('.prof', '.json'):
+                try:
+                    os.remove(os.path.join(self.directory, name + ext))
+                except FileNotFoundError:
+                    pass
+
+    def _dump(self, request: web.Request, profile: cProfile.Profile, timer: PhaseTimer, error=None):
+        handler_time = timer.phases.pop('handler', 0)
+        timer.phases['build'] = handler_time - sum(v for k, v in timer.phases.items() if k != 'write')
+
+        name = '{}_{}_{}_{}'.format(
+            time.strftime('%Y%m%d%H%M%S'),
+            uuid.uuid4().hex[:8],
+            request.method,
+            re.sub(r'[^\w]+', '_', request.path).strip('_')
+        )
+        path = os.path.join(self.directory, name)
+        profile.dump_stats(path + '.prof')
+        with open(path + '.json', 'w') as fd:
+            json.dump({'url': str(request.rel_url), 'phases': timer.phases, 'error': error}, fd, indent=2)
+        logging.info("Profiled {} {}{}:\n{}".format(
+            request.method, request.rel_url, ' ({})'.format(error) if error else '', timer.report()
+        ))
+        self._prune()
+
+    def _safe_dump(self, request: web.Request, profile: cProfile.Profile, timer: PhaseTimer, error=None):
+        # the response is already sent or failing on its own, a dump failure must not change it
+        try:
+            self._dump(request, profile, timer, error)
+        except Exception as e:
+            logging.error("Unable to dump the profile of {} {}, {}".format(request.method, request.rel_url, e))
+
+    @web.middleware
+    async def middleware(self, request: web.Request, handler) -> web.StreamResponse:
+        if not self._requested(request):
+            return await handler(request)
+        # a single profiler can be enabled at a time, concurrent ones would mix their stats (and fail on 3.12+)
+        if self._active:
+            return await handler(request)
+
+        self._active = True
+        timer = PhaseTimer()
+        token = timer.activate()
+        profile = cProfile.Profile()
+        profile.enable()
+        try:
+            with timer.phase('handler'):
+                response = await handler(request)
+            # sent here to be timed, aiohttp skips already prepared responses
+            with timer.phase('write'):
+                await response.prepare(request)
+                await response.write_eof()
+        except BaseException as e:
+            profile.disable()
+            error = e.__class__.__name__
+            if isinstance(e, web.HTTPException):
+                error = '{} {}'.format(error, e.status)
+            self._safe_dump(request, profile, timer, error)
+            raise
+        else:
+            profile.disable()
+            self._safe_dump(request, profile, timer)
+        finally:
+            timer.deactivate(token)
+            self._active = False
+
+        return response
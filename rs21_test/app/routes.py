@@ -0,0 +1,21 @@
+# -*- coding: utf-8 -*-
+
+"""RS21 API routes"""
+
+from aiohttp import web
+
+from rs21_test.app.handlers.facebook import FacebookHandler, FacebookTypePlacesHandler
+from rs21_test.app.handlers.twitter import TwitterHandler, TwitterByIdHandler
+from rs21_test.app.handlers.bernallio import BernallioHandler, BernallioGeometriesHandler, BernallioChoroplethHandler
+from rs21_test.app.handlers.metrics import MetricsHandler
+
+routes = [
+    web.get('/api/v1/facebook', FacebookHandler),
+    web.get('/api/v1/facebook_type_places', FacebookTypePlacesHandler),
+    web.get('/api/v1/twitter', TwitterHandler),
+    web.view('/api/v1/twitter/{id}', TwitterByIdHandler),
+    web.get('/api/v1/bernallio', BernallioHandler),
+    web.get('/api/v1/geometries', BernallioGeometriesHandler),
+    web.get('/api/v1/choropleth', BernallioChoroplethHandler),
+    web.get('/api/v1/metrics', MetricsHandler),
+]
@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+
+"""Request coalescing"""
+
+import asyncio
+
+from aiohttp import hdrs, web
+
+WRITE_METHODS = (hdrs.METH_POST, hdrs.METH_PUT, hdrs.METH_PATCH, hdrs.METH_DELETE)
+
+
+class SingleFlight:
+    """
+    Share one handler call between identical concurrent GET requests.
+
+    The first request for a path and query (the leader) runs the handler, requests arriving while it is in flight
+    wait for it and get a copy of its encoded body. Only complete ``200`` responses are shared, otherwise followers
+    run the handler themselves. A write forgets in-flight reads, so later readers do not get data read before it.
+    """
+
+    def __init__(self):
+        self._inflight = {}
+        self.executed = 0
+        self.coalesced = 0
+        self.fallbacks = 0
+        self.saved_bytes = 0
+
+    def stats(self) -> dict:
+        return {
+            'inflight': len(self._inflight),
+            'executed': self.executed,
+            'coalesced': self.coalesced,
+            'fallbacks': self.fallbacks,
+            'saved_bytes': self.saved_bytes,
+        }
+
+    @web.middleware
+    async def middleware(self, request: web.Request, handler) -> web.StreamResponse:
+        if request.method != hdrs.METH_GET:
+            try:
+                return await handler(request)
+            finally:
+                if request.method in WRITE_METHODS:
+                    self._inflight.clear()
+
+        key = (request.path, tuple(sorted(request.query.items())))
+
+        future = self._inflight.get(key)
+        if future is not None:
+            # shielded, a cancelled follower must not cancel the result for the others
+            shared = await asyncio.shield(future)
+            if shared is None:
+                self.fallbacks += 1
+                return await handler(request)
+
+            body, content_type, charset = shared
+            self.coalesced += 1
+            self.saved_bytes += len(body)
+            return web.Response(body=body, content_type=content_type, charset=charset)
+
+        future = asyncio.get_event_loop().create_future()
+        self._inflight[key] = future
+        self.executed += 1
+
+        shared = None
+        try:
+            response = await handler(request)
+            if isinstance(response, web.Response) and response.status == 200 and isinstance(response.body, bytes):
+                shared = (response.body, response.content_type, response.charset)
+            return response
+        finally:
+            if self._inflight.get(key) is future:
+                del self._inflight[key]
+            future.set_result(shared)
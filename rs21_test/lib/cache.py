@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+
+"""In-process caches"""
+
+import time
+from collections import OrderedDict
+
+
+class LRUCache:
+    """
+    Bounded mapping evicting the least recently used entry, entries optionally expire after ``ttl`` seconds.
+
+    With ``max_bytes`` values are sized with ``len()`` and the total is bounded as well, a value larger than the whole
+    budget is not stored.
+    """
+
+    def __init__(self, max_entries=1024, ttl=None, max_bytes=None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._data = OrderedDict()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key, default=None):
+        try:
+            value, expires = self._data[key]
+        except KeyError:
+            return default
+        if expires is not None and expires < time.monotonic():
+            self._pop(key)
+            return default
+        self._data.move_to_end(key)
+        return value
+
+    def _sizeof(self, value) -> int:
+        return len(value) if self.max_bytes is not None else 0
+
+    def _pop(self, key):
+        value, _ = self._data.pop(key)
+        self.size -= self._sizeof(value)
+
+    def set(self, key, value):
+        if key in self._data:
+            self._pop(key)
+        if self.max_bytes is not None and self._sizeof(value) > self.max_bytes:
+            return
+
+        expires = time.monotonic() + self.ttl if self.ttl else None
+        self._data[key] = (value, expires)
+        self.size += self._sizeof(value)
+        while len(self._data) > self.max_entries or (self.max_bytes is not None and self.size > self.max_bytes):
+            self._pop(next(iter(self._data)))
+
+    def clear(self):
+        self._data.clear()
+        self.size = 0
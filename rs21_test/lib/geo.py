@@ -0,0 +1,143 @@
+# -*- coding: utf-8 -*-
+
+"""Geo helpers"""
+
+import math
+import asyncio
+import logging
+
+from rs21_test.lib.cache import LRUCache
+from rs21_test.lib.profiling import phase
+
+# Radius used by Mongo for 2dsphere distances
+EARTH_RADIUS = 6378100.0
+
+
+def haversine(lon1: float, lat1: float, lon2: float, lat2: float) -> float:
+    """
+    Great-circle distance in meters
+    """
+    lon1, lat1, lon2, lat2 = map(math.radians, (lon1, lat1, lon2, lat2))
+    a = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS * math.asin(min(1.0, math.sqrt(a)))
+
+
+class GeoQueryCache:
+    """
+    Cache of ``$near`` lookups keyed by grid cell instead of raw coordinates.
+
+    The query point is snapped to a ``cell_size`` degrees grid and ``dist`` is rounded up to ``dist_step`` meters.
+    On a miss Mongo is asked for everything around the cell center that any point of the cell could reach, then
+    the exact distance filter is applied in-process, so lookups a few meters apart share one candidate set.
+    Candidate sets larger than ``max_candidates`` are not cached. Lookups of a collection are dropped whenever the
+    loader publishes a new version of its dataset or a write through the API bumps its ``writes`` counter, in every
+    API process within ``refresh_interval``.
+    """
+
+    def __init__(self, cell_size=0.001, dist_step=100, max_entries=1024, max_candidates=5000, ttl=600,
+                 refresh_interval=10):
+        self.cell_size = cell_size
+        self.dist_step = dist_step
+        self.max_entries = max_entries
+        self.max_candidates = max_candidates
+        self.ttl = ttl
+        self.refresh_interval = refresh_interval
+        self._caches = {}
+        self._generations = {}
+        self._versions = {}
+        self._task = None
+
+    def _cache(self, name: str) -> LRUCache:
+        if name not in self._caches:
+            self._caches[name] = LRUCache(self.max_entries, self.ttl)
+        return self._caches[name]
+
+    def _cell(self, lon: float, lat: float):
+        cell = (math.floor(lon / self.cell_size), math.floor(lat / self.cell_size))
+        center = ((cell[0] + 0.5) * self.cell_size, (cell[1] + 0.5) * self.cell_size)
+        # the cell is widest on the edge closer to the equator, take the farthest corner
+        radius = max(
+            haversine(center[0], center[1], cell[0] * self.cell_size, cell[1] * self.cell_size),
+            haversine(center[0], center[1], cell[0] * self.cell_size, (cell[1] + 1) * self.cell_size),
+        )
+        return cell, center, radius
+
+    def invalidate(self, name: str):
+        """
+        Drop cached lookups of the collection, e.g. after a write
+        """
+        self._generations[name] = self._generations.get(name, 0) + 1
+        self._cache(name).clear()
+
+    async def written(self, db, name: str):
+        """
+        Drop cached lookups of the collection after a write, here and, through its dataset, in the other processes
+        """
+        self.invalidate(name)
+        await db.datasets.update_one({'_id': name}, {'$inc': {'writes': 1}}, upsert=True)
+
+    async def refresh(self, db):
+        """
+        Invalidate the collections whose dataset version or writes counter changed since the last check
+        """
+        async for dataset in db.datasets.find({}):
+            name = dataset['_id']
+            version = (dataset.get('version'), dataset.get('writes'))
+            if self._versions.get(name) != version:
+                self._versions[name] = version
+                self.invalidate(name)
+
+    async def _run(self, app):
+        while True:
+            try:
+                await self.refresh(app._db)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logging.error("Unable to check datasets versions for the geo cache, {}".format(e))
+            await asyncio.sleep(self.refresh_interval)
+
+    async def start(self, app):
+        self._task = asyncio.ensure_future(self._run(app))
+
+    async def stop(self, app):
+        if self._task is not None:
+            self._task.cancel()
+
+    async def near(self, collection, query_filter: dict, lon: float, lat: float, dist: float,
+                   projection=None, key=()) -> list:
+        """
+        Documents of ``collection`` matching ``query_filter`` within ``dist`` meters, nearest first
+        :param key: hashable representation of ``query_filter``
+        """
+        cell, center, radius = self._cell(lon, lat)
+        bucket = math.ceil(dist / self.dist_step) * self.dist_step
+        cache_key = (key, cell, bucket)
+
+        cache = self._cache(collection.name)
+        candidates = cache.get(cache_key)
+        if candidates is None:
+            generation = self._generations.get(collection.name, 0)
+            geo_filter = dict(query_filter)
+            geo_filter['location'] = {
+                '$near': {
+                    '$geometry': {
+                        'type': "Point",
+                        'coordinates': list(center)},
+                    '$maxDistance': bucket + radius
+                }
+            }
+            with phase('mongo'):
+                candidates = await collection.find(geo_filter, projection).to_list(length=None)
+            # do not cache what was read while the collection was changing
+            if len(candidates) <= self.max_candidates and generation == self._generations.get(collection.name, 0):
+                cache.set(cache_key, candidates)
+
+        result = []
+        for doc in candidates:
+            doc_lon, doc_lat = doc['location']['coordinates']
+            doc_dist = haversine(lon, lat, doc_lon, doc_lat)
+            if doc_dist <= dist:
+                result.append((doc_dist, doc))
+        result.sort(key=lambda x: x[0])
+        return [doc for _, doc in result]
@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+
+"""Incremental GeoJSON reader"""
+
+import json
+
+CHUNK_SIZE = 1 << 16
+
+_WHITESPACE = ' \t\n\r'
+
+
+class GeoJSONReader:
+    """
+    Stream the ``features`` of a GeoJSON FeatureCollection one at a time.
+
+    Only the feature being decoded (and a read-ahead chunk) is held in memory, so large tract files can be loaded
+    without reading the whole document.
+    """
+
+    def __init__(self, fd, chunk_size=CHUNK_SIZE):
+        self._fd = fd
+        self._chunk_size = chunk_size
+        self._decoder = json.JSONDecoder()
+        self._buf = ''
+        self._pos = 0
+        self._eof = False
+
+    def _read(self, size=None) -> bool:
+        """
+        Append the next chunk to the buffer, dropping the already consumed part
+        :return: False when the file is exhausted
+        """
+        if self._eof:
+            return False
+        chunk = self._fd.read(size or self._chunk_size)
+        if not chunk:
+            self._eof = True
+            return False
+        self._buf = self._buf[self._pos:] + chunk
+        self._pos = 0
+        return True
+
+    def _peek(self) -> str:
+        """
+        Skip whitespace and return the next significant character ('' at the end of file)
+        """
+        while True:
+            while self._pos < len(self._buf) and self._buf[self._pos] in _WHITESPACE:
+                self._pos += 1
+            if self._pos < len(self._buf):
+                return self._buf[self._pos]
+            if not self._read():
+                return ''
+
+    def _expect(self, chars: str) -> str:
+        char = self._peek()
+        if not char or char not in chars:
+            raise ValueError("Malformed GeoJSON: expected one of {!r}, got {!r}".format(chars, char))
+        self._pos += 1
+        return char
+
+    def _decode(self):
+        """
+        Decode the next JSON value, reading more data until it is complete
+        """
+        self._peek()
+        while True:
+            try:
+                value, end = self._decoder.raw_decode(self._buf, self._pos)
+            except json.JSONDecodeError:
+                # grow the read size with the pending value, so huge geometries are not re-parsed once per chunk
+                if not self._read(max(self._chunk_size, len(self._buf) - self._pos)):
+                    raise
+                continue
+            # a number at the very end of the buffer may continue in the next chunk
+            if end == len(self._buf) and self._read():
+                continue
+            self._pos = end
+            return value
+
+    def __iter__(self):
+        self._expect('{')
+        if self._peek() == '}':
+            return
+        while True:
+            key = self._decode()
+            self._expect(':')
+            if key == 'features':
+                self._expect('[')
+                if self._peek() == ']':
+                    self._pos += 1
+                else:
+                    while True:
+                        yield self._decode()
+                        if self._expect(',]') == ']':
+                            break
+            else:
+                self._decode()
+            if self._expect(',}') == '}':
+                return
+
+
+def iter_features(fd, chunk_size=CHUNK_SIZE):
+    """
+    Yield features of the GeoJSON document opened as ``fd``
+    """
+    return iter(GeoJSONReader(fd, chunk_size))
@@ -15,4 +15,11 @@ def default(obj):
 
 
 def json_dumps(*args, **kwargs):
-    return dumps(default=default, *args, **kwargs)
\ No newline at end of file
+    return dumps(default=default, *args, **kwargs)
+
+
+def normalize_key(value: str) -> str:
+    """
+    Lower-cased, whitespace collapsed value stored next to the original field for indexed lookups
+    """
+    return ' '.join(value.split()).lower()
@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+
+"""Phase timing"""
+
+import time
+import contextvars
+from collections import OrderedDict
+from contextlib import contextmanager
+
+_current_timer = contextvars.ContextVar('phase_timer', default=None)
+
+
+class PhaseTimer:
+    """
+    Accumulates wall time by named phase
+    """
+
+    def __init__(self):
+        self.phases = OrderedDict()
+
+    @contextmanager
+    def phase(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases[name] = self.phases.get(name, 0) + time.perf_counter() - start
+
+    def report(self) -> str:
+        return '\n'.join('{:<24} {:.3f} sec'.format(name, value) for name, value in self.phases.items())
+
+    def activate(self):
+        """
+        Make the timer current for ``phase()`` calls of this context (the request task)
+        :return: token for ``deactivate``
+        """
+        return _current_timer.set(self)
+
+    @staticmethod
+    def deactivate(token):
+        _current_timer.reset(token)
+
+
+@contextmanager
+def phase(name: str):
+    """
+    Time a phase with the current timer, no-op when none is active
+    """
+    timer = _current_timer.get()
+    if timer is None:
+        yield
+        return
+    with timer.phase(name):
+        yield
@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+
+"""Tweet sentiment scoring"""
+
+import hashlib
+import shelve
+
+from vaderSentiment.vaderSentiment import SentimentIntensityAnalyzer
+
+try:
+    from importlib.metadata import version as _dist_version
+except ImportError:  # python < 3.8
+    from pkg_resources import get_distribution
+
+    def _dist_version(name):
+        return get_distribution(name).version
+
+ANALYZER_VERSION = 'vaderSentiment-{}'.format(_dist_version('vaderSentiment'))
+
+_VERSION_KEY = '__version__'
+
+
+def get_sentiment(x: float) -> int:
+    """
+    Map VADER compound score to the stored sentiment value
+    """
+    if x > 0:
+        return 1  # positive
+    if x < 0:
+        return -1  # negative
+    return 0  # neutral
+
+
+def normalize_text(text: str) -> str:
+    """
+    Collapse whitespace, VADER tokenizes on it anyway. Case is kept, it affects the score.
+    """
+    return ' '.join(text.split())
+
+
+class SentimentCache:
+    """
+    Memoize ``polarity_scores`` by a hash of the normalized text.
+
+    Scores are kept in memory for the current run and, when ``path`` is given, in a shelve file reused by next runs.
+    The file is dropped as soon as it was written by another analyzer version.
+    """
+
+    def __init__(self, path=None, analyser=None):
+        self._analyser = analyser or SentimentIntensityAnalyzer()
+        self._memory = {}
+        self._store = None
+        self.hits = 0
+        self.misses = 0
+
+        if path:
+            self._store = shelve.open(path)
+            if self._store.get(_VERSION_KEY) != ANALYZER_VERSION:
+                self._store.clear()
+                self._store[_VERSION_KEY] = ANALYZER_VERSION
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def polarity_scores(self, text: str) -> dict:
+        text = normalize_text(text)
+        key = hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+        scores = self._memory.get(key)
+        if scores is None and self._store is not None:
+            scores = self._store.get(key)
+            if scores is not None:
+                self._memory[key] = scores
+
+        if scores is not None:
+            self.hits += 1
+            return scores
+
+        self.misses += 1
+        scores = self._analyser.polarity_scores(text)
+        self._memory[key] = scores
+        if self._store is not None:
+            self._store[key] = scores
+        return scores
+
+    def sentiment(self, text: str) -> int:
+        return get_sentiment(self.polarity_scores(text)['compound'])
+
+    def close(self):
+        if self._store is not None:
+            self._store.close()
+            self._store = None
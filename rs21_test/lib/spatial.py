@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+
+"""In-memory spatial index"""
+
+import heapq
+import math
+from collections import defaultdict
+
+from rs21_test.lib.geo import EARTH_RADIUS, haversine
+
+# Allowed error of the equirectangular projection against great-circle distances, city sized datasets stay far below
+PROJECTION_SLACK = 0.01
+
+
+class GridIndex:
+    """
+    Uniform grid over points projected around their mean latitude.
+
+    Built from ``(lon, lat, item)`` tuples, answers radius and k-nearest queries with the same great-circle distance
+    Mongo uses, by scanning grid rings outwards from the query cell until no closer point can be left.
+    """
+
+    def __init__(self, points, cell_size=250):
+        self.cell_size = cell_size
+        self._points = list(points)
+        self._cells = defaultdict(list)
+
+        lat0 = sum(p[1] for p in self._points) / len(self._points) if self._points else 0.0
+        self._kx = math.radians(1) * EARTH_RADIUS * math.cos(math.radians(lat0))
+        self._ky = math.radians(1) * EARTH_RADIUS
+
+        for i, (lon, lat, _) in enumerate(self._points):
+            self._cells[self._cell(lon, lat)].append(i)
+
+        if self._cells:
+            self._bounds = (
+                min(c[0] for c in self._cells), max(c[0] for c in self._cells),
+                min(c[1] for c in self._cells), max(c[1] for c in self._cells),
+            )
+
+    def __len__(self):
+        return len(self._points)
+
+    def _cell(self, lon: float, lat: float):
+        return math.floor(lon * self._kx / self.cell_size), math.floor(lat * self._ky / self.cell_size)
+
+    def _ring(self, cx: int, cy: int, r: int):
+        """
+        Cells of the ring ``r`` around ``(cx, cy)`` clipped to the grid bounds
+        """
+        min_x, max_x, min_y, max_y = self._bounds
+        if r == 0:
+            yield cx, cy
+            return
+        x_from, x_to = max(cx - r, min_x), min(cx + r, max_x)
+        for y in (cy - r, cy + r):
+            if min_y <= y <= max_y:
+                for x in range(x_from, x_to + 1):
+                    yield x, y
+        y_from, y_to = max(cy - r + 1, min_y), min(cy + r - 1, max_y)
+        for x in (cx - r, cx + r):
+            if min_x <= x <= max_x:
+                for y in range(y_from, y_to + 1):
+                    yield x, y
+
+    def near(self, lon: float, lat: float, dist=None, k=None, predicate=None) -> list:
+        """
+        Items within ``dist`` meters (any distance if None), at most ``k`` of them, nearest first
+        :param predicate: callable filtering items
+        """
+        if not self._cells or k == 0:
+            return []
+
+        cx, cy = self._cell(lon, lat)
+        min_x, max_x, min_y, max_y = self._bounds
+        max_ring = max(cx - min_x, max_x - cx, cy - min_y, max_y - cy)
+        # rings closer than the grid bounds are empty, a query far from the data starts at the bounds
+        r = max(min_x - cx, cx - max_x, min_y - cy, cy - max_y, 0)
+        if dist is not None and (r - 1) * self.cell_size * (1 - PROJECTION_SLACK) > dist:
+            return []
+
+        found = []
+        while r <= max_ring:
+            for cell in self._ring(cx, cy, r):
+                for i in self._cells.get(cell, ()):
+                    p_lon, p_lat, item = self._points[i]
+                    d = haversine(lon, lat, p_lon, p_lat)
+                    if dist is not None and d > dist:
+                        continue
+                    if predicate is not None and not predicate(item):
+                        continue
+                    found.append((d, i))
+
+            # points of the next rings are at least this far
+            bound = r * self.cell_size * (1 - PROJECTION_SLACK)
+            if dist is not None and bound > dist:
+                break
+            if k is not None and len(found) >= k and heapq.nsmallest(k, found)[-1][0] <= bound:
+                break
+            r += 1
+
+        found = heapq.nsmallest(k, found) if k is not None else sorted(found)
+        return [self._points[i][2] for _, i in found]
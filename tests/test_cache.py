@@ -0,0 +1,37 @@
+# -*- coding: utf-8 -*-
+
+from rs21_test.lib.cache import LRUCache
+
+
+def test_evicts_least_recently_used():
+    cache = LRUCache(max_entries=2)
+    cache.set('a', 1)
+    cache.set('b', 2)
+    assert cache.get('a') == 1
+    cache.set('c', 3)
+    assert cache.get('b') is None
+    assert cache.get('a') == 1
+    assert cache.get('c') == 3
+
+
+def test_bounded_by_bytes():
+    cache = LRUCache(max_bytes=10)
+    cache.set('a', b'12345')
+    cache.set('b', b'1234')
+    assert cache.size == 9
+    cache.set('c', b'123')
+    assert cache.get('a') is None
+    assert cache.size == 7
+
+    # replacing a value accounts only the new one
+    cache.set('c', b'12')
+    assert cache.size == 6
+
+    # larger than the whole budget, not stored
+    cache.set('d', b'12345678901')
+    assert cache.get('d') is None
+    assert cache.size == 6
+
+    cache.clear()
+    assert cache.size == 0
+    assert len(cache) == 0
@@ -0,0 +1,219 @@
+# -*- coding: utf-8 -*-
+
+import asyncio
+import datetime
+
+from pymongo.errors import BulkWriteError
+
+from rs21_test.app.derived import DerivedFieldsQueue, PENDING_FIELD, FAILED_FIELD
+
+MISSING = object()
+
+
+def get_path(doc, path):
+    for part in path.split('.'):
+        if not isinstance(doc, dict) or part not in doc:
+            return MISSING
+        doc = doc[part]
+    return doc
+
+
+def set_path(doc, path, value):
+    *parents, last = path.split('.')
+    for part in parents:
+        doc = doc.setdefault(part, {})
+    doc[last] = value
+
+
+def unset_path(doc, path):
+    *parents, last = path.split('.')
+    for part in parents:
+        doc = doc.get(part, {})
+    doc.pop(last, None)
+
+
+def match(doc, query):
+    for key, condition in query.items():
+        if key == '$or':
+            if not any(match(doc, sub) for sub in condition):
+                return False
+            continue
+        value = get_path(doc, key)
+        if not isinstance(condition, dict):
+            if value is MISSING or value != condition:
+                return False
+            continue
+        for op, arg in condition.items():
+            if op == '$exists' and (value is not MISSING) != arg:
+                return False
+            if op == '$in' and (value is MISSING or value not in arg):
+                return False
+            if op in ('$lt', '$gte') and value is MISSING:
+                return False
+            if op == '$lt' and not value < arg:
+                return False
+            if op == '$gte' and not value >= arg:
+                return False
+    return True
+
+
+def apply(doc, update):
+    for path, value in update.get('$set', {}).items():
+        set_path(doc, path, value)
+    for path in update.get('$unset', {}):
+        unset_path(doc, path)
+
+
+class FakeCursor:
+    def __init__(self, docs):
+        self._docs = docs
+
+    def sort(self, path, direction):
+        self._docs.sort(key=lambda doc: get_path(doc, path))
+        return self
+
+    def limit(self, count):
+        self._docs = self._docs[:count]
+        return self
+
+    async def to_list(self, length=None):
+        return self._docs
+
+
+class FakeTwitter:
+    """
+    Just enough of a motor collection for the queue, ``fail`` rejects updates setting one of its fields
+    """
+
+    def __init__(self, docs, fail=()):
+        self.docs = docs
+        self.fail = fail
+        self.before_write = None
+
+    def find(self, query, projection=None):
+        return FakeCursor([dict(doc) for doc in self.docs if match(doc, query)])
+
+    async def update_many(self, query, update):
+        for doc in self.docs:
+            if match(doc, query):
+                apply(doc, update)
+
+    async def bulk_write(self, requests, ordered=True):
+        if self.before_write is not None:
+            self.before_write()
+            self.before_write = None
+        errors = []
+        for i, request in enumerate(requests):
+            update = request._doc
+            if any(field in self.fail for field in update.get('$set', {})):
+                errors.append({'index': i, 'code': 121, 'errmsg': 'Document failed validation'})
+                continue
+            for doc in self.docs:
+                if match(doc, request._filter):
+                    apply(doc, update)
+                    break
+        if errors:
+            raise BulkWriteError({'writeErrors': errors})
+
+
+class FakeGeoCache:
+    def __init__(self):
+        self.writes = 0
+
+    async def written(self, db, name):
+        self.writes += 1
+
+
+class FakeDB:
+    def __init__(self, twitter):
+        self.twitter = twitter
+
+
+class FakeApp:
+    def __init__(self, twitter):
+        self._db = FakeDB(twitter)
+        self.geo_cache = FakeGeoCache()
+
+
+def patched(_id, fields, **values):
+    doc = {'_id': _id, 'tweet': 'I love this great city', 'lon': -106.6, 'lat': 35.08}
+    doc.update(values)
+    for path, value in DerivedFieldsQueue.mark(fields).items():
+        set_path(doc, path, value)
+    return doc
+
+
+def test_recomputes_marked_fields():
+    twitter = FakeTwitter([patched(1, ['sentiment', 'location'])])
+    app = FakeApp(twitter)
+
+    assert asyncio.run(DerivedFieldsQueue()._process_batch(app)) == 1
+    doc = twitter.docs[0]
+    assert doc['sentiment'] == 1
+    assert doc['location'] == {'type': 'Point', 'coordinates': [-106.6, 35.08]}
+    assert PENDING_FIELD not in doc
+    assert app.geo_cache.writes == 1
+
+
+def test_renewed_mark_is_kept():
+    twitter = FakeTwitter([patched(1, ['sentiment', 'location'])])
+    app = FakeApp(twitter)
+
+    def patch_meanwhile():
+        # a PATCH of the text lands while the batch is computed
+        doc = twitter.docs[0]
+        doc['tweet'] = 'I hate this awful city'
+        renewed = datetime.datetime.utcnow() + datetime.timedelta(seconds=1)
+        set_path(doc, PENDING_FIELD + '.sentiment', renewed)
+        set_path(doc, PENDING_FIELD + '.at', renewed)
+
+    twitter.before_write = patch_meanwhile
+    queue = DerivedFieldsQueue()
+    asyncio.run(queue._process_batch(app))
+
+    doc = twitter.docs[0]
+    # the location mark was not renewed and is done, the sentiment read before the PATCH is not written
+    assert doc['location']['coordinates'] == [-106.6, 35.08]
+    assert 'sentiment' not in doc
+    assert set(doc[PENDING_FIELD]) == {'sentiment', 'at'}
+
+    # released right away, the next batch picks the renewed mark
+    asyncio.run(queue._process_batch(app))
+    assert doc['sentiment'] == -1
+    assert PENDING_FIELD not in doc
+
+
+def test_claimed_tweets_are_skipped():
+    twitter = FakeTwitter([patched(1, ['sentiment']), patched(2, ['sentiment'])])
+    set_path(twitter.docs[0], PENDING_FIELD + '.claim', 'other')
+    set_path(twitter.docs[0], PENDING_FIELD + '.claimed_until',
+             datetime.datetime.utcnow() + datetime.timedelta(seconds=60))
+    app = FakeApp(twitter)
+
+    assert asyncio.run(DerivedFieldsQueue()._process_batch(app)) == 1
+    assert 'sentiment' not in twitter.docs[0]
+    assert twitter.docs[1]['sentiment'] == 1
+
+    # an expired lease is picked again
+    set_path(twitter.docs[0], PENDING_FIELD + '.claimed_until',
+             datetime.datetime.utcnow() - datetime.timedelta(seconds=1))
+    assert asyncio.run(DerivedFieldsQueue()._process_batch(app)) == 1
+    assert twitter.docs[0]['sentiment'] == 1
+
+
+def test_failed_write_is_dead_lettered():
+    twitter = FakeTwitter([patched(1, ['sentiment', 'location'])], fail=('sentiment',))
+    app = FakeApp(twitter)
+    at = twitter.docs[0][PENDING_FIELD]['sentiment']
+
+    queue = DerivedFieldsQueue()
+    asyncio.run(queue._process_batch(app))
+
+    doc = twitter.docs[0]
+    assert 'location' in doc
+    assert 'sentiment' not in doc
+    assert doc[FAILED_FIELD] == {'sentiment': at}
+    assert PENDING_FIELD not in doc
+    assert queue.dead_lettered == 1
+
+    assert asyncio.run(queue._process_batch(app)) == 0
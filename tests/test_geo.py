@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+
+import random
+import asyncio
+
+from rs21_test.lib.geo import GeoQueryCache, haversine
+
+
+class FakeCursor:
+    def __init__(self, docs, on_fetch=None):
+        self._docs = docs
+        self._on_fetch = on_fetch
+
+    async def to_list(self, length=None):
+        if self._on_fetch is not None:
+            self._on_fetch()
+        return list(self._docs)
+
+
+class FakeGeoCollection:
+    """
+    Answers ``$near`` filters with a brute-force distance scan
+    """
+
+    def __init__(self, name, docs, on_fetch=None):
+        self.name = name
+        self.docs = docs
+        self.on_fetch = on_fetch
+        self.finds = 0
+
+    def find(self, query_filter, projection=None):
+        self.finds += 1
+        near = query_filter['location']['$near']
+        lon, lat = near['$geometry']['coordinates']
+        found = sorted(
+            (haversine(lon, lat, *doc['location']['coordinates']), i, doc) for i, doc in enumerate(self.docs)
+        )
+        return FakeCursor([doc for d, _, doc in found if d <= near['$maxDistance']], self.on_fetch)
+
+
+class FakeDatasets:
+    def __init__(self):
+        self.docs = {}
+
+    async def update_one(self, query, update, upsert=False):
+        doc = self.docs.setdefault(query['_id'], {'_id': query['_id']})
+        for field, value in update['$inc'].items():
+            doc[field] = doc.get(field, 0) + value
+
+    async def find(self, query):
+        for doc in list(self.docs.values()):
+            yield dict(doc)
+
+
+class FakeDB:
+    def __init__(self):
+        self.datasets = FakeDatasets()
+
+
+def make_docs(count=500, seed=1):
+    rnd = random.Random(seed)
+    return [
+        {'_id': i, 'location': {'type': 'Point', 'coordinates': [-106.6 + rnd.uniform(-0.01, 0.01),
+                                                                  35.08 + rnd.uniform(-0.01, 0.01)]}}
+        for i in range(count)
+    ]
+
+
+def brute_force(docs, lon, lat, dist):
+    found = sorted(
+        (haversine(lon, lat, *doc['location']['coordinates']), doc['_id'])
+        for doc in docs
+        if haversine(lon, lat, *doc['location']['coordinates']) <= dist
+    )
+    return [_id for _, _id in found]
+
+
+def test_near_matches_brute_force():
+    docs = make_docs()
+    collection = FakeGeoCollection('twitter', docs)
+    cache = GeoQueryCache()
+    rnd = random.Random(2)
+
+    async def run():
+        for _ in range(50):
+            lon, lat = -106.6 + rnd.uniform(-0.01, 0.01), 35.08 + rnd.uniform(-0.01, 0.01)
+            dist = rnd.uniform(10, 500)
+            result = await cache.near(collection, {}, lon, lat, dist)
+            assert [doc['_id'] for doc in result] == brute_force(docs, lon, lat, dist)
+
+    asyncio.run(run())
+
+
+def test_near_lookups_share_the_cell():
+    collection = FakeGeoCollection('twitter', make_docs())
+    cache = GeoQueryCache(cell_size=0.001, dist_step=100)
+
+    async def run():
+        await cache.near(collection, {}, -106.60051, 35.08051, 90)
+        await cache.near(collection, {}, -106.60052, 35.08052, 95)
+        assert collection.finds == 1
+
+        cache.invalidate('twitter')
+        await cache.near(collection, {}, -106.60051, 35.08051, 90)
+        assert collection.finds == 2
+
+    asyncio.run(run())
+
+
+def test_write_during_lookup_is_not_cached():
+    cache = GeoQueryCache()
+    collection = FakeGeoCollection('twitter', make_docs(), on_fetch=lambda: cache.invalidate('twitter'))
+
+    async def run():
+        await cache.near(collection, {}, -106.6, 35.08, 100)
+        await cache.near(collection, {}, -106.6, 35.08, 100)
+        assert collection.finds == 2
+
+    asyncio.run(run())
+
+
+def test_writes_reach_other_processes():
+    db = FakeDB()
+    collection = FakeGeoCollection('twitter', make_docs())
+    writer, reader = GeoQueryCache(), GeoQueryCache()
+
+    async def run():
+        await reader.refresh(db)
+        await reader.near(collection, {}, -106.6, 35.08, 100)
+        await reader.refresh(db)
+        await reader.near(collection, {}, -106.6, 35.08, 100)
+        assert collection.finds == 1
+
+        await writer.written(db, 'twitter')
+        await reader.refresh(db)
+        await reader.near(collection, {}, -106.6, 35.08, 100)
+        assert collection.finds == 2
+
+    asyncio.run(run())
@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+
+import io
+import json
+
+import pytest
+
+from rs21_test.lib.geojson import iter_features
+
+
+def make_collection(count=50):
+    return {
+        'type': 'FeatureCollection',
+        # members before "features", including a nested "features" key, must be skipped
+        'crs': {'type': 'name', 'properties': {'features': [1, 2, 3]}},
+        'count': 123456,
+        'features': [
+            {
+                'type': 'Feature',
+                'properties': {'GEOID': str(i), 'INTPTLAT': '+35.08', 'value': i * 1.5},
+                'geometry': {'type': 'Polygon', 'coordinates': [[[-106.6 + i, 35.08 + i]] * 20]},
+            }
+            for i in range(count)
+        ],
+        'bbox': [-107, 35, -106, 36],
+    }
+
+
+@pytest.mark.parametrize('chunk_size', [1, 2, 7, 64, 1 << 16])
+def test_features_across_chunk_boundaries(chunk_size):
+    collection = make_collection()
+    text = json.dumps(collection, indent=1)
+    assert list(iter_features(io.StringIO(text), chunk_size)) == collection['features']
+
+
+def test_compact_document():
+    collection = make_collection(3)
+    text = json.dumps(collection, separators=(',', ':'))
+    assert list(iter_features(io.StringIO(text), 5)) == collection['features']
+
+
+@pytest.mark.parametrize('text', ['{}', '{"features": []}', '{"type": "FeatureCollection", "features": [ ]}'])
+def test_no_features(text):
+    assert list(iter_features(io.StringIO(text))) == []
+
+
+def test_is_lazy():
+    text = '{"features": [{"a": 1}, {"a": 2}, broken'
+    features = iter_features(io.StringIO(text), 4)
+    assert next(features) == {'a': 1}
+    assert next(features) == {'a': 2}
+    with pytest.raises(ValueError):
+        next(features)
+
+
+def test_malformed_document():
+    with pytest.raises(ValueError):
+        list(iter_features(io.StringIO('[]')))
@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+
+import asyncio
+
+from aiohttp import web
+from aiohttp.test_utils import TestClient, TestServer
+
+from rs21_test.app.singleflight import SingleFlight
+
+
+def make_app(singleflight, handler):
+    app = web.Application(middlewares=[singleflight.middleware])
+    app.router.add_get('/items', handler)
+    app.router.add_patch('/items', handler)
+    return app
+
+
+def run(singleflight, handler, scenario):
+    async def main():
+        async with TestClient(TestServer(make_app(singleflight, handler))) as client:
+            return await scenario(client)
+    return asyncio.run(main())
+
+
+def test_concurrent_gets_share_one_call():
+    singleflight = SingleFlight()
+    calls = []
+
+    async def handler(request):
+        calls.append(request.query_string)
+        await asyncio.sleep(0.1)
+        return web.json_response({'calls': len(calls)})
+
+    async def scenario(client):
+        responses = await asyncio.gather(*[client.get('/items?a=1') for _ in range(5)])
+        return [await response.json() for response in responses]
+
+    bodies = run(singleflight, handler, scenario)
+    assert len(calls) == 1
+    assert bodies == [{'calls': 1}] * 5
+    assert singleflight.stats()['coalesced'] == 4
+    assert singleflight.stats()['inflight'] == 0
+
+
+def test_different_queries_are_not_shared():
+    singleflight = SingleFlight()
+    calls = []
+
+    async def handler(request):
+        calls.append(request.query_string)
+        await asyncio.sleep(0.1)
+        return web.json_response({})
+
+    async def scenario(client):
+        await asyncio.gather(client.get('/items?a=1'), client.get('/items?a=2'))
+
+    run(singleflight, handler, scenario)
+    assert sorted(calls) == ['a=1', 'a=2']
+
+
+def test_errors_are_not_shared():
+    singleflight = SingleFlight()
+    calls = []
+
+    async def handler(request):
+        calls.append(request.query_string)
+        await asyncio.sleep(0.1)
+        return web.json_response({'error': 1}, status=500)
+
+    async def scenario(client):
+        responses = await asyncio.gather(*[client.get('/items') for _ in range(3)])
+        return [response.status for response in responses]
+
+    assert run(singleflight, handler, scenario) == [500] * 3
+    assert len(calls) == 3
+    assert singleflight.stats()['fallbacks'] == 2
+
+
+def test_write_forgets_inflight_reads():
+    singleflight = SingleFlight()
+    calls = []
+
+    async def handler(request):
+        calls.append(request.method)
+        if request.method == 'GET':
+            await asyncio.sleep(0.2)
+        return web.json_response({'calls': len(calls)})
+
+    async def scenario(client):
+        first = asyncio.ensure_future(client.get('/items'))
+        await asyncio.sleep(0.05)
+        await client.patch('/items')
+        # arrives after the write, must not get the body read before it
+        second = await client.get('/items')
+        await first
+        return await second.json()
+
+    body = run(singleflight, handler, scenario)
+    assert calls.count('GET') == 2
+    assert body == {'calls': 3}
@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+
+import random
+
+from rs21_test.lib.geo import haversine
+from rs21_test.lib.spatial import GridIndex
+
+
+def brute_force(points, lon, lat, dist=None, k=None, predicate=None):
+    found = sorted(
+        (haversine(lon, lat, p_lon, p_lat), item)
+        for p_lon, p_lat, item in points
+        if (predicate is None or predicate(item)) and (dist is None or haversine(lon, lat, p_lon, p_lat) <= dist)
+    )
+    return [item for _, item in found][:k]
+
+
+def make_points(count=2000, seed=1):
+    rnd = random.Random(seed)
+    return [(-106.6 + rnd.uniform(-0.1, 0.1), 35.08 + rnd.uniform(-0.1, 0.1), i) for i in range(count)]
+
+
+def test_empty_index():
+    index = GridIndex([])
+    assert len(index) == 0
+    assert index.near(-106.6, 35.08, dist=100) == []
+    assert index.near(-106.6, 35.08, k=5) == []
+
+
+def test_radius_query_matches_brute_force():
+    points = make_points()
+    index = GridIndex(points, cell_size=250)
+    rnd = random.Random(2)
+    for _ in range(100):
+        lon, lat = -106.6 + rnd.uniform(-0.12, 0.12), 35.08 + rnd.uniform(-0.12, 0.12)
+        dist = rnd.choice([50, 300, 1000, 5000])
+        assert index.near(lon, lat, dist=dist) == brute_force(points, lon, lat, dist=dist)
+
+
+def test_knn_query_matches_brute_force():
+    points = make_points()
+    index = GridIndex(points, cell_size=250)
+    rnd = random.Random(3)
+    for _ in range(100):
+        lon, lat = -106.6 + rnd.uniform(-0.12, 0.12), 35.08 + rnd.uniform(-0.12, 0.12)
+        k = rnd.choice([1, 10, 50])
+        assert index.near(lon, lat, k=k) == brute_force(points, lon, lat, k=k)
+
+
+def test_predicate_and_distance_with_k():
+    points = make_points()
+    index = GridIndex(points, cell_size=250)
+
+    def predicate(item):
+        return item % 3 == 0
+
+    result = index.near(-106.6, 35.08, dist=3000, k=10, predicate=predicate)
+    assert result == brute_force(points, -106.6, 35.08, dist=3000, k=10, predicate=predicate)
+    assert all(predicate(item) for item in result)
+
+
+def spy_rings(index):
+    rings = []
+    ring = index._ring
+
+    def spy(cx, cy, r):
+        rings.append(r)
+        return ring(cx, cy, r)
+
+    index._ring = spy
+    return rings
+
+
+def test_far_query_is_bounded_by_the_data():
+    points = make_points()
+    index = GridIndex(points, cell_size=250)
+    min_x, max_x, min_y, max_y = index._bounds
+    width = max(max_x - min_x, max_y - min_y)
+
+    # ~550 km and ~2000 km away from the data
+    for lon, k in ((-100.8, 1), (-84.0, 3)):
+        rings = spy_rings(index)
+        assert index.near(lon, 35.08, k=k) == brute_force(points, lon, 35.08, k=k)
+
+        # the scan starts at the edge of the data and does not go beyond its far side
+        cx, _ = index._cell(lon, 35.08)
+        assert rings[0] == cx - max_x
+        assert len(rings) <= width + 1
+
+    rings = spy_rings(index)
+    assert index.near(-100.8, 35.08, dist=1000) == []
+    assert rings == []
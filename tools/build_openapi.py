@@ -0,0 +1,21 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""Write the RS21 API OpenAPI spec, loaded by the API at startup instead of parsing the handlers docstrings"""
+
+import argparse
+import json
+
+from rs21_test.app.openapi import build_spec
+from rs21_test.app.routes import routes
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-o', '--output', dest='output', help='spec file', required=True)
+    args = parser.parse_args()
+
+    # built before opening the output, a failure leaves the previous spec in place
+    spec = json.dumps(build_spec(routes), indent=2)
+    with open(args.output, 'w') as fd:
+        fd.write(spec)
@@ -4,19 +4,22 @@
 """Data Loader"""
 
 import argparse
-import time
 import datetime
 import os
-import json
 import re
 
 import yaml
 from pymongo import ASCENDING, GEOSPHERE
 
-from vaderSentiment.vaderSentiment import SentimentIntensityAnalyzer
-
 from rs21_test.lib.db import DatabaseConfig
-from rs21_test.app.handlers.bernallio import MIN_AGE, MAX_AGE
+from rs21_test.lib.geojson import iter_features
+from rs21_test.lib.misc import normalize_key
+from rs21_test.lib.profiling import PhaseTimer
+from rs21_test.lib.sentiment import SentimentCache
+from rs21_test.app.handlers.bernallio import MIN_AGE, MAX_AGE, category_field
+from rs21_test.app.derived import PENDING_FIELD
+
+BATCH_SIZE = 1000
 
 
 class DataLoader:
@@ -31,43 +34,71 @@ class DataLoader:
             self.cfg['MONGO_DB']['DB_NAME'],
         )
 
+        self.timer = PhaseTimer()
+
+    def _timed(self, name, iterable):
+        """
+        Iterate accounting the time spent in the iterable itself to the ``name`` phase
+        """
+        iterator = iter(iterable)
+        while True:
+            with self.timer.phase(name):
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+            yield item
+
+    def _set_version(self, dataset):
+        """
+        Publish a new version of the dataset, the API rebuilds what it derived from it
+        """
+        self._db.datasets.replace_one(
+            {'_id': dataset},
+            {'_id': dataset, 'version': datetime.datetime.utcnow()},
+            upsert=True
+        )
+
     def load_twitter(self):
         """
         Load Twitter entries
         """
 
-        def get_sentim(x: int) -> int:
-            if x > 0:
-                return 1  # positive
-            if x < 0:
-                return -1  # negative
-            return 0  # neutral
-
         self._db.twitter.drop()
         self._db.twitter.create_index([("username", ASCENDING)])
+        self._db.twitter.create_index([("username_key", ASCENDING)])
         self._db.twitter.create_index([("twit", ASCENDING)])
         self._db.twitter.create_index([("time", ASCENDING)])
         self._db.twitter.create_index([("location", GEOSPHERE)])
         self._db.twitter.create_index([("sentiment", ASCENDING)])
+        self._db.twitter.create_index([(PENDING_FIELD + ".at", ASCENDING)], sparse=True)
 
         twitter_data = []
-        twitter_files = filter(lambda x: x.endswith('csv'), os.listdir(self.cfg['LOADER']['DATA']['TWITTER']))
-        for file_name in map(lambda x: os.path.join(self.cfg['LOADER']['DATA']['TWITTER'], x), twitter_files):
-            with open(file_name, 'r', encoding='latin-1') as fd:
-                twitter_data = list(filter(lambda x: len(x) == 5, [x.rsplit(',', 4) for x in fd.readlines()]))
-                
-        analyser = SentimentIntensityAnalyzer()
+        with self.timer.phase('twitter.read'):
+            twitter_files = filter(lambda x: x.endswith('csv'), os.listdir(self.cfg['LOADER']['DATA']['TWITTER']))
+            for file_name in map(lambda x: os.path.join(self.cfg['LOADER']['DATA']['TWITTER'], x), twitter_files):
+                with open(file_name, 'r', encoding='latin-1') as fd:
+                    twitter_data = list(filter(lambda x: len(x) == 5, [x.rsplit(',', 4) for x in fd.readlines()]))
 
         new_objects = []
-        for row in twitter_data:
-            new_objects.append({
-                'username': row[1],
-                'tweet': row[0],
-                'datetime': datetime.datetime.strptime(row[4].strip('\n').strip(';'), '%Y-%m-%d %H:%M:%S'),
-                'location': {"type": "Point", "coordinates": [float(row[3]), float(row[2])]},
-                'sentiment': get_sentim(analyser.polarity_scores(row[0])['compound'])
-            })
-        self._db.twitter.insert_many(new_objects)
+        with self.timer.phase('twitter.parse'):
+            for row in twitter_data:
+                new_objects.append({
+                    'username': row[1],
+                    'username_key': normalize_key(row[1]),
+                    'tweet': row[0],
+                    'datetime': datetime.datetime.strptime(row[4].strip('\n').strip(';'), '%Y-%m-%d %H:%M:%S'),
+                    'location': {"type": "Point", "coordinates": [float(row[3]), float(row[2])]},
+                })
+
+        # retweets and duplicated texts are scored only once, across loader runs as well
+        with self.timer.phase('twitter.sentiment'), SentimentCache(self.cfg['LOADER'].get('SENTIMENT_CACHE')) as analyser:
+            for new_obj in new_objects:
+                new_obj['sentiment'] = analyser.sentiment(new_obj['tweet'])
+
+        with self.timer.phase('twitter.insert'):
+            self._db.twitter.insert_many(new_objects)
+            self._set_version('twitter')
 
     def load_facebook(self):
         """
@@ -76,24 +107,32 @@ class DataLoader:
         self._db.facebook.drop()
         self._db.facebook.create_index([("place", ASCENDING)])
         self._db.facebook.create_index([("type", ASCENDING)])
+        self._db.facebook.create_index([("place_key", ASCENDING)])
+        self._db.facebook.create_index([("type_key", ASCENDING)])
         self._db.facebook.create_index([("location", GEOSPHERE)])
 
         facebook_data = []
-        facebook_files = filter(lambda x: x.endswith('csv'), os.listdir(self.cfg['LOADER']['DATA']['FACEBOOK']))
-        for file_name in map(lambda x: os.path.join(self.cfg['LOADER']['DATA']['FACEBOOK'], x), facebook_files):
-            with open(file_name, 'r', encoding='latin-1') as fd:
-                facebook_data = list(filter(lambda x: len(x) == 5, [x.rsplit(',', 4) for x in [n.replace('\n', '').rstrip(',,,') for n in fd.readlines()]]))
+        with self.timer.phase('facebook.read'):
+            facebook_files = filter(lambda x: x.endswith('csv'), os.listdir(self.cfg['LOADER']['DATA']['FACEBOOK']))
+            for file_name in map(lambda x: os.path.join(self.cfg['LOADER']['DATA']['FACEBOOK'], x), facebook_files):
+                with open(file_name, 'r', encoding='latin-1') as fd:
+                    facebook_data = list(filter(lambda x: len(x) == 5, [x.rsplit(',', 4) for x in [n.replace('\n', '').rstrip(',,,') for n in fd.readlines()]]))
 
         new_objects = []
-        for row in facebook_data:
-            new_objects.append({
-                'place': row[0],
-                'type': row[1],
-                'checkins': int(row[2]),
-                'location': {"type": "Point", "coordinates": [float(row[4]), float(row[3])]}
-            })
-
-        self._db.facebook.insert_many(new_objects)
+        with self.timer.phase('facebook.parse'):
+            for row in facebook_data:
+                new_objects.append({
+                    'place': row[0],
+                    'place_key': normalize_key(row[0]),
+                    'type': row[1],
+                    'type_key': normalize_key(row[1]),
+                    'checkins': int(row[2]),
+                    'location': {"type": "Point", "coordinates": [float(row[4]), float(row[3])]}
+                })
+
+        with self.timer.phase('facebook.insert'):
+            self._db.facebook.insert_many(new_objects)
+            self._set_version('facebook')
 
     def load_bernallio(self):
         """
@@ -161,50 +200,81 @@ class DataLoader:
         self._db.geometries.create_index([("GEOID", ASCENDING)])
         self._db.geometries.create_index([("geometry", GEOSPHERE)])
 
-        mapper = prepare_mapper()
+        # tracts geometries joined with age/gender census values, map views select the categories by projection
+        self._db.choropleth.drop()
+        self._db.choropleth.create_index([("GEOID", ASCENDING)])
+
+        with self.timer.phase('bernallio.metadata'):
+            mapper = prepare_mapper()
+            choropleth_fields = set(
+                category_field(category) for category in self._db.census_filters.find({'type': 'age'})
+            )
+
+        batch_size = int(self.cfg['LOADER'].get('BATCH_SIZE', BATCH_SIZE))
 
         geometries = []
         new_objects = []
+        choropleth = []
         json_files = filter(lambda x: x.endswith('json'), os.listdir(self.cfg['LOADER']['DATA']['BERNALLIO']))
         for json_filename in json_files:
-            data = json.loads(open(os.path.join(self.cfg['LOADER']['DATA']['BERNALLIO'], json_filename), 'r').read())
-            for item in data['features']:
-                new_geometry = {
-                    'geometry': item['geometry']
-                }
-
-                new_obj = {
-                    'city': "Bernallio",
-                }
-
-                geo = {}
-                for k, v in item['properties'].items():
-                    k = k.replace('.', '-')
-                    if k == "GEOID":
-                        new_obj[k] = v
-                        new_geometry[k] = v
-
-                    if k in ["INTPTLON", "INTPTLAT"]:
-                        geo[k] = float(v)
-                    else:
-                        new_obj[k] = v
-                        # k_ = k.split("_with_ann_")
-                        # if len(k_) == 2:
-                        #     new_obj[k.replace('.', '-')] = {
-                        #         'description': mapper[k_[0]].get(k_[1]),
-                        #         'value': v
-                        #     }
-                        # else:
-                        #     new_obj[k_[0]] = {
-                        #         'value': v
-                        #     }
-                new_obj['location'] = {"type": "Point", "coordinates": [geo["INTPTLON"], geo["INTPTLAT"]]}
-
-                geometries.append(new_geometry)
-                new_objects.append(new_obj)
-
-        self._db.cities.insert_many(new_objects)
-        self._db.geometries.insert_many(geometries)
+            with open(os.path.join(self.cfg['LOADER']['DATA']['BERNALLIO'], json_filename), 'r') as fd:
+                for item in self._timed('bernallio.read', iter_features(fd)):
+                    with self.timer.phase('bernallio.parse'):
+                        new_geometry = {
+                            'geometry': item['geometry']
+                        }
+
+                        new_obj = {
+                            'city': "Bernallio",
+                        }
+
+                        geo = {}
+                        for k, v in item['properties'].items():
+                            k = k.replace('.', '-')
+                            if k == "GEOID":
+                                new_obj[k] = v
+                                new_geometry[k] = v
+
+                            if k in ["INTPTLON", "INTPTLAT"]:
+                                geo[k] = float(v)
+                            else:
+                                new_obj[k] = v
+                                # k_ = k.split("_with_ann_")
+                                # if len(k_) == 2:
+                                #     new_obj[k.replace('.', '-')] = {
+                                #         'description': mapper[k_[0]].get(k_[1]),
+                                #         'value': v
+                                #     }
+                                # else:
+                                #     new_obj[k_[0]] = {
+                                #         'value': v
+                                #     }
+                        new_obj['location'] = {"type": "Point", "coordinates": [geo["INTPTLON"], geo["INTPTLAT"]]}
+
+                        geometries.append(new_geometry)
+                        new_objects.append(new_obj)
+                        choropleth.append({
+                            'GEOID': new_obj.get('GEOID'),
+                            'geometry': item['geometry'],
+                            'values': {k: v for k, v in new_obj.items() if k in choropleth_fields},
+                        })
+
+                    # flush by batches, so memory is bounded by the batch size rather than by the file size
+                    if len(new_objects) >= batch_size:
+                        with self.timer.phase('bernallio.insert'):
+                            self._db.cities.insert_many(new_objects)
+                            self._db.geometries.insert_many(geometries)
+                            self._db.choropleth.insert_many(choropleth)
+                        geometries = []
+                        new_objects = []
+                        choropleth = []
+
+        with self.timer.phase('bernallio.insert'):
+            if new_objects:
+                self._db.cities.insert_many(new_objects)
+                self._db.geometries.insert_many(geometries)
+                self._db.choropleth.insert_many(choropleth)
+            self._set_version('bernallio')
 
 
 if __name__ == '__main__':
@@ -212,11 +282,11 @@ if __name__ == '__main__':
     parser.add_argument('-c', '--config', dest='config', help='config file', required=True)
     args = parser.parse_args()
 
-    start = int(time.time())
     app = DataLoader(args.config)
 
-    app.load_facebook()
-    app.load_twitter()
-    app.load_bernallio()
+    with app.timer.phase('total'):
+        app.load_facebook()
+        app.load_twitter()
+        app.load_bernallio()
 
-    print("Finished in {} sec".format(int(time.time()) - start))
+    print(app.timer.report())